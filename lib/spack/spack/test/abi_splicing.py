@@ -4,31 +4,84 @@
 # SPDX-License-Identifier: (Apache-2.0 OR MIT)
 """ Test ABI-based splicing of dependencies """
 
-from typing import List
+import contextlib
+import os
+from typing import Dict, List, Optional, Tuple
 
 import pytest
 
+import spack.concretize
 import spack.config
 import spack.deptypes as dt
+import spack.error
 import spack.solver.asp
+import spack.store
 from spack.installer import PackageInstaller
 from spack.spec import Spec
 
 
+#: Concrete specs keyed by (spec string, automatic splicing enabled), shared across tests.
+#: The splice setting is part of the key so that results obtained with and without
+#: automatic splicing never collide
+_CONCRETIZATION_CACHE: Dict[Tuple[str, bool], Spec] = {}
+
+
+def _concretize_all(spec_strs: Tuple[str, ...]) -> List[Spec]:
+    """Concretize the input specs separately, reusing results from previous calls"""
+    splice_automatic = bool(spack.config.get("concretizer:splice:automatic", False))
+    missing = [
+        s for s in dict.fromkeys(spec_strs) if (s, splice_automatic) not in _CONCRETIZATION_CACHE
+    ]
+    if len(missing) >= 2 and not splice_automatic:
+        # Independent solves, so run them in a process pool where possible
+        pairs = spack.concretize.concretize_separately([(Spec(s), None) for s in missing])
+        concrete = [c for _, c in pairs]
+    else:
+        concrete = [Spec(s).concretized() for s in missing]
+    for s, c in zip(missing, concrete):
+        _CONCRETIZATION_CACHE[(s, splice_automatic)] = c
+    return [_CONCRETIZATION_CACHE[(s, splice_automatic)].copy(deps=True) for s in spec_strs]
+
+
 class CacheManager:
-    def __init__(self, specs: List[str]) -> None:
+    """Makes the requested specs available for reuse within the context.
+
+    By default the specs are fake installed. With ``install=False`` only their
+    prefix metadata and database records are created, which is enough for
+    tests that just concretize against them.
+    """
+
+    def __init__(self, specs: Tuple[str, ...], install: bool = True) -> None:
         self.req_specs = specs
+        self.install = install
         self.concr_specs: List[Spec]
         self.concr_specs = []
 
     def __enter__(self):
-        self.concr_specs = [Spec(s).concretized() for s in self.req_specs]
-        for s in self.concr_specs:
-            PackageInstaller([s.package], fake=True, explicit=True).install()
+        self.concr_specs = _concretize_all(self.req_specs)
+        if self.install:
+            PackageInstaller(
+                [s.package for s in self.concr_specs], fake=True, explicit=True
+            ).install()
+            return
+
+        store = spack.store.STORE
+        with store.db.write_transaction():
+            for s in self.concr_specs:
+                for node in s.traverse():
+                    if not node.external and not os.path.isdir(node.prefix):
+                        store.layout.create_install_directory(node)
+                store.db.add(s, explicit=True)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        for s in self.concr_specs:
-            s.package.do_uninstall()
+        store = spack.store.STORE
+        with store.db.write_transaction():
+            for s in self.concr_specs:
+                if self.install:
+                    s.package.do_uninstall()
+                else:
+                    store.db.remove(s)
+                    store.layout.remove_install_directory(s)
 
 
 # MacOS and Windows only work if you pass this function pointer rather than a
@@ -44,182 +97,202 @@ def _make_specs_non_buildable(specs: List[str]):
     return output_config
 
 
+# Package configs shared by more than one test. Tests only use these as a whole
+# "packages" section override, and never modify them
+_CFG_SPLICE_Z = _make_specs_non_buildable(["splice-z"])
+_CFG_VIRTUAL_WITH_ABI = _make_specs_non_buildable(["depends-on-virtual-with-abi"])
+_CFG_MANYVARIANTS = _make_specs_non_buildable(["depends-on-manyvariants"])
+
+
+@pytest.fixture(scope="module")
+def _splicing_env():
+    """Patch out the runtime dependency check once for the whole module"""
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(
+            spack.solver.asp, "_has_runtime_dependencies", _mock_has_runtime_dependencies
+        )
+        yield
+
+
 @pytest.fixture
-def splicing_setup(mutable_database, mock_packages, monkeypatch):
-    spack.config.set("concretizer:reuse", True)
-    monkeypatch.setattr(
-        spack.solver.asp, "_has_runtime_dependencies", _mock_has_runtime_dependencies
-    )
+def splicing_setup(_splicing_env, mutable_database, mock_packages):
+    # mutable_database and mock_packages are function scoped, so the per-test
+    # part is kept to a config override that is undone on exit
+    with spack.config.override("concretizer:reuse", True):
+        yield
 
 
-def _enable_splicing():
-    spack.config.set("concretizer:splice", {"automatic": True})
+@contextlib.contextmanager
+def _splicing_enabled():
+    with spack.config.override("concretizer:splice", {"automatic": True}):
+        yield
+
+
+def _try_concretize(spec: Spec) -> Optional[Spec]:
+    """Returns a concrete copy of the input spec, or None if the concretizer cannot find
+    a solution for it.
+    """
+    try:
+        return spec.concretized()
+    except spack.error.SpackError:
+        return None
 
 
 def _has_build_dependency(spec: Spec, name: str):
-    return any(s.name == name for s in spec.dependencies(None, dt.BUILD))
+    return bool(spec.edges_to_dependencies(name, depflag=dt.BUILD))
 
 
 def test_simple_reuse(splicing_setup):
-    with CacheManager(["splice-z@1.0.0+compat"]):
-        spack.config.set("packages", _make_specs_non_buildable(["splice-z"]))
+    cache = ("splice-z@1.0.0+compat",)
+    with CacheManager(cache, install=False), spack.config.override("packages", _CFG_SPLICE_Z):
         assert Spec("splice-z").concretized().satisfies(Spec("splice-z"))
 
 
 def test_simple_dep_reuse(splicing_setup):
-    with CacheManager(["splice-z@1.0.0+compat"]):
-        spack.config.set("packages", _make_specs_non_buildable(["splice-z"]))
+    cache = ("splice-z@1.0.0+compat",)
+    with CacheManager(cache, install=False), spack.config.override("packages", _CFG_SPLICE_Z):
         assert Spec("splice-h@1").concretized().satisfies(Spec("splice-h@1"))
 
 
 def test_splice_installed_hash(splicing_setup):
-    cache = [
+    cache = (
         "splice-t@1 ^splice-h@1.0.0+compat ^splice-z@1.0.0",
         "splice-h@1.0.2+compat ^splice-z@1.0.0",
-    ]
-    with CacheManager(cache):
-        packages_config = _make_specs_non_buildable(["splice-t", "splice-h"])
-        spack.config.set("packages", packages_config)
+    )
+    packages_config = _make_specs_non_buildable(["splice-t", "splice-h"])
+    with CacheManager(cache), spack.config.override("packages", packages_config):
         goal_spec = Spec("splice-t@1 ^splice-h@1.0.2+compat ^splice-z@1.0.0")
-        with pytest.raises(Exception):
-            goal_spec.concretized()
-        _enable_splicing()
-        assert goal_spec.concretized().satisfies(goal_spec)
+        assert _try_concretize(goal_spec) is None
+        with _splicing_enabled():
+            assert goal_spec.concretized().satisfies(goal_spec)
 
 
 def test_splice_build_splice_node(splicing_setup):
-    with CacheManager(["splice-t@1 ^splice-h@1.0.0+compat ^splice-z@1.0.0+compat"]):
-        spack.config.set("packages", _make_specs_non_buildable(["splice-t"]))
+    cache = ("splice-t@1 ^splice-h@1.0.0+compat ^splice-z@1.0.0+compat",)
+    packages_config = _make_specs_non_buildable(["splice-t"])
+    with CacheManager(cache), spack.config.override("packages", packages_config):
         goal_spec = Spec("splice-t@1 ^splice-h@1.0.2+compat ^splice-z@1.0.0+compat")
-        with pytest.raises(Exception):
-            goal_spec.concretized()
-        _enable_splicing()
-        assert goal_spec.concretized().satisfies(goal_spec)
+        assert _try_concretize(goal_spec) is None
+        with _splicing_enabled():
+            assert goal_spec.concretized().satisfies(goal_spec)
 
 
 def test_double_splice(splicing_setup):
-    cache = [
+    cache = (
         "splice-t@1 ^splice-h@1.0.0+compat ^splice-z@1.0.0+compat",
         "splice-h@1.0.2+compat ^splice-z@1.0.1+compat",
         "splice-z@1.0.2+compat",
-    ]
-    with CacheManager(cache):
-        freeze_builds_config = _make_specs_non_buildable(["splice-t", "splice-h", "splice-z"])
-        spack.config.set("packages", freeze_builds_config)
+    )
+    freeze_builds_config = _make_specs_non_buildable(["splice-t", "splice-h", "splice-z"])
+    with CacheManager(cache), spack.config.override("packages", freeze_builds_config):
         goal_spec = Spec("splice-t@1 ^splice-h@1.0.2+compat ^splice-z@1.0.2+compat")
-        with pytest.raises(Exception):
-            goal_spec.concretized()
-        _enable_splicing()
-        assert goal_spec.concretized().satisfies(goal_spec)
+        assert _try_concretize(goal_spec) is None
+        with _splicing_enabled():
+            assert goal_spec.concretized().satisfies(goal_spec)
+
+
+# Goal specs are parsed once at import time. Parsing does not need the mock repository,
+# and tests never modify these objects, since concretized() works on a copy
+_VIRTUAL_MULTI_GOALS = (
+    Spec("depends-on-virtual-with-abi ^virtual-abi-multi abi=one"),
+    Spec("depends-on-virtual-with-abi ^virtual-abi-multi abi=two"),
+)
+
+_VIRTUAL_SINGLE_GOALS = (
+    Spec("depends-on-virtual-with-abi ^virtual-abi-1"),
+    Spec("depends-on-virtual-with-abi ^virtual-abi-2"),
+)
+
+_MANYVARIANT_STAR_GOALS = (
+    Spec("depends-on-manyvariants ^manyvariants@1.0.1+a+b c=v1 d=v2"),
+    Spec("depends-on-manyvariants ^manyvariants@1.0.1~a~b c=v3 d=v3"),
+)
+
+_MANYVARIANT_LIMITED_GOALS = (
+    Spec("depends-on-manyvariants@2.0 ^manyvariants@2.0.1~a+b c=v3 d=v2"),
+    Spec("depends-on-manyvariants@2.0 ^manyvariants@2.0.1+a+b c=v3 d=v3"),
+)
+
+_EXTERNAL_SAME_NAME_GOALS = (
+    Spec("splice-h@1.0.0 ^splice-z@1.0.2"),
+    Spec("splice-t@1.0 ^splice-h@1.0.1 ^splice-z@1.0.2"),
+)
 
 
 # The next two tests are mirrors of one another
 def test_virtual_multi_splices_in(splicing_setup):
-    cache = [
+    cache = (
         "depends-on-virtual-with-abi ^virtual-abi-1",
         "depends-on-virtual-with-abi ^virtual-abi-2",
-    ]
-    goal_specs = [
-        "depends-on-virtual-with-abi ^virtual-abi-multi abi=one",
-        "depends-on-virtual-with-abi ^virtual-abi-multi abi=two",
-    ]
-    with CacheManager(cache):
-        spack.config.set("packages", _make_specs_non_buildable(["depends-on-virtual-with-abi"]))
-        for gs in goal_specs:
-            with pytest.raises(Exception):
-                Spec(gs).concretized()
-        _enable_splicing()
-        for gs in goal_specs:
-            assert Spec(gs).concretized().satisfies(gs)
+    )
+    with CacheManager(cache), spack.config.override("packages", _CFG_VIRTUAL_WITH_ABI):
+        for gs in _VIRTUAL_MULTI_GOALS:
+            assert _try_concretize(gs) is None
+        with _splicing_enabled():
+            for gs in _VIRTUAL_MULTI_GOALS:
+                assert gs.concretized().satisfies(gs)
 
 
 def test_virtual_multi_can_be_spliced(splicing_setup):
-    cache = [
+    cache = (
         "depends-on-virtual-with-abi ^virtual-abi-multi abi=one",
         "depends-on-virtual-with-abi ^virtual-abi-multi abi=two",
-    ]
-    goal_specs = [
-        "depends-on-virtual-with-abi ^virtual-abi-1",
-        "depends-on-virtual-with-abi ^virtual-abi-2",
-    ]
-    with CacheManager(cache):
-        spack.config.set("packages", _make_specs_non_buildable(["depends-on-virtual-with-abi"]))
-        with pytest.raises(Exception):
-            for gs in goal_specs:
-                Spec(gs).concretized()
-        _enable_splicing()
-        for gs in goal_specs:
-            assert Spec(gs).concretized().satisfies(gs)
+    )
+    with CacheManager(cache), spack.config.override("packages", _CFG_VIRTUAL_WITH_ABI):
+        assert any(_try_concretize(gs) is None for gs in _VIRTUAL_SINGLE_GOALS)
+        with _splicing_enabled():
+            for gs in _VIRTUAL_SINGLE_GOALS:
+                assert gs.concretized().satisfies(gs)
 
 
 def test_manyvariant_star_matching_variant_splice(splicing_setup):
-    cache = [
+    cache = (
         # can_splice("manyvariants@1.0.0", when="@1.0.1", match_variants="*")
         "depends-on-manyvariants ^manyvariants@1.0.0+a+b c=v1 d=v2",
         "depends-on-manyvariants ^manyvariants@1.0.0~a~b c=v3 d=v3",
-    ]
-    goal_specs = [
-        Spec("depends-on-manyvariants ^manyvariants@1.0.1+a+b c=v1 d=v2"),
-        Spec("depends-on-manyvariants ^manyvariants@1.0.1~a~b c=v3 d=v3"),
-    ]
-    with CacheManager(cache):
-        freeze_build_config = {"depends-on-manyvariants": {"buildable": False}}
-        spack.config.set("packages", freeze_build_config)
-        for goal in goal_specs:
-            with pytest.raises(Exception):
-                goal.concretized()
-        _enable_splicing()
-        for goal in goal_specs:
-            assert goal.concretized().satisfies(goal)
+    )
+    with CacheManager(cache), spack.config.override("packages", _CFG_MANYVARIANTS):
+        for goal in _MANYVARIANT_STAR_GOALS:
+            assert _try_concretize(goal) is None
+        with _splicing_enabled():
+            for goal in _MANYVARIANT_STAR_GOALS:
+                assert goal.concretized().satisfies(goal)
 
 
 def test_manyvariant_limited_matching(splicing_setup):
-    cache = [
+    cache = (
         # can_splice("manyvariants@2.0.0+a~b", when="@2.0.1~a+b", match_variants=["c", "d"])
         "depends-on-manyvariants@2.0 ^manyvariants@2.0.0+a~b c=v3 d=v2",
         # can_splice("manyvariants@2.0.0 c=v1 d=v1", when="@2.0.1+a+b")
         "depends-on-manyvariants@2.0 ^manyvariants@2.0.0~a~b c=v1 d=v1",
-    ]
-    goal_specs = [
-        Spec("depends-on-manyvariants@2.0 ^manyvariants@2.0.1~a+b c=v3 d=v2"),
-        Spec("depends-on-manyvariants@2.0 ^manyvariants@2.0.1+a+b c=v3 d=v3"),
-    ]
-    with CacheManager(cache):
-        freeze_build_config = {"depends-on-manyvariants": {"buildable": False}}
-        spack.config.set("packages", freeze_build_config)
-        for s in goal_specs:
-            with pytest.raises(Exception):
-                s.concretized()
-        _enable_splicing()
-        for s in goal_specs:
-            assert s.concretized().satisfies(s)
+    )
+    with CacheManager(cache), spack.config.override("packages", _CFG_MANYVARIANTS):
+        for s in _MANYVARIANT_LIMITED_GOALS:
+            assert _try_concretize(s) is None
+        with _splicing_enabled():
+            for s in _MANYVARIANT_LIMITED_GOALS:
+                assert s.concretized().satisfies(s)
 
 
 def test_external_splice_same_name(splicing_setup):
-    cache = [
+    cache = (
         "splice-h@1.0.0 ^splice-z@1.0.0+compat",
         "splice-t@1.0 ^splice-h@1.0.1 ^splice-z@1.0.1+compat",
-    ]
+    )
     packages_yaml = {
         "splice-z": {"externals": [{"spec": "splice-z@1.0.2+compat", "prefix": "/usr"}]}
     }
-    goal_specs = [
-        Spec("splice-h@1.0.0 ^splice-z@1.0.2"),
-        Spec("splice-t@1.0 ^splice-h@1.0.1 ^splice-z@1.0.2"),
-    ]
-    with CacheManager(cache):
-        spack.config.set("packages", packages_yaml)
-        _enable_splicing()
-        for s in goal_specs:
-            assert s.concretized().satisfies(s)
+    with CacheManager(cache), spack.config.override("packages", packages_yaml):
+        with _splicing_enabled():
+            for s in _EXTERNAL_SAME_NAME_GOALS:
+                assert s.concretized().satisfies(s)
 
 
 def test_spliced_build_deps_only_in_build_spec(splicing_setup):
-    cache = ["splice-t@1.0 ^splice-h@1.0.1 ^splice-z@1.0.0"]
+    cache = ("splice-t@1.0 ^splice-h@1.0.1 ^splice-z@1.0.0",)
     goal_spec = Spec("splice-t@1.0 ^splice-h@1.0.2 ^splice-z@1.0.0")
 
-    with CacheManager(cache):
-        _enable_splicing()
+    with CacheManager(cache), _splicing_enabled():
         concr_goal = goal_spec.concretized()
         build_spec = concr_goal._build_spec
         # Spec has been spliced
@@ -232,16 +305,16 @@ def test_spliced_build_deps_only_in_build_spec(splicing_setup):
 
 
 def test_spliced_transitive_dependency(splicing_setup):
-    cache = ["splice-depends-on-t@1.0 ^splice-h@1.0.1"]
+    cache = ("splice-depends-on-t@1.0 ^splice-h@1.0.1",)
     goal_spec = Spec("splice-depends-on-t^splice-h@1.0.2")
-
-    with CacheManager(cache):
-        spack.config.set("packages", _make_specs_non_buildable(["splice-depends-on-t"]))
-        _enable_splicing()
-        concr_goal = goal_spec.concretized()
-        # Spec has been spliced
-        assert concr_goal._build_spec is not None
-        assert concr_goal["splice-t"]._build_spec is not None
-        assert concr_goal.satisfies(goal_spec)
-        # Spliced build dependencies are removed
-        assert len(concr_goal.dependencies(None, dt.BUILD)) == 0
+    packages_config = _make_specs_non_buildable(["splice-depends-on-t"])
+
+    with CacheManager(cache), spack.config.override("packages", packages_config):
+        with _splicing_enabled():
+            concr_goal = goal_spec.concretized()
+            # Spec has been spliced
+            assert concr_goal._build_spec is not None
+            assert concr_goal["splice-t"]._build_spec is not None
+            assert concr_goal.satisfies(goal_spec)
+            # Spliced build dependencies are removed
+            assert len(concr_goal.dependencies(None, dt.BUILD)) == 0
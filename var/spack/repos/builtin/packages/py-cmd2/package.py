@@ -27,8 +27,8 @@ class PyCmd2(PythonPackage):
     depends_on("py-wcwidth", type=("build", "run"))
 
     depends_on("py-pytest", type=("build", "run"), when="+test")
-    depends_on("py-pytest-cov", type=("build","run"), when="+test")
-    depends_on("py-pytest-mock", type=("build","run"), when="+test")
+    depends_on("py-pytest-cov", type=("build", "run"), when="+test")
+    depends_on("py-pytest-mock", type=("build", "run"), when="+test")
 
     depends_on("py-pyreadline", when="platform=windows +readline", type=("build", "run"))
     depends_on("readline", when="platform=darwin +readline", type=("build", "run"))